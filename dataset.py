@@ -4,17 +4,447 @@ library from HuggingFace.
 """
 
 import csv
-import random
-from collections.abc import Callable, Generator, Iterator, Mapping
+import functools
+import itertools
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from collections import deque
+from collections.abc import Callable, Generator, Iterator, Mapping, Sequence
+from concurrent.futures import Future, ThreadPoolExecutor
 from io import BytesIO
 from pathlib import Path
 from types import EllipsisType
 from typing import Any, Protocol, runtime_checkable
 
 import numpy as np
+import numpy.typing
 import rasterio
 from dvc.api import DVCFileSystem
 
+try:
+    from numba import njit, prange
+except ImportError:  # pragma: no cover - numba is optional
+    njit = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - pyarrow is optional
+    pa = pq = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - zstandard is optional
+    zstandard = None
+
+
+if njit is not None:
+
+    # Full fastmath would assume no NaNs and drop the `v != v` check.
+    _FASTMATH = {"nsz", "arcp", "contract", "afn", "reassoc"}
+
+    @njit(fastmath=_FASTMATH, cache=True)
+    def _normalize_value(v: float) -> float:
+        if v != v:
+            v = 0.0
+        if v < -50.0:
+            v = -50.0
+        elif v > 1.0:
+            v = 1.0
+        return (v + 50.0) * (1.0 / 51.0)
+
+    @njit(parallel=True, fastmath=_FASTMATH, cache=True)
+    def _normalize(img_in: np.ndarray, out: np.ndarray) -> None:
+        # Rows are split across threads: there are only a couple of bands.
+        for i in prange(img_in.shape[1]):
+            for c in range(img_in.shape[0]):
+                for j in range(img_in.shape[2]):
+                    out[c, i, j] = _normalize_value(img_in[c, i, j])
+
+    @njit(fastmath=_FASTMATH, cache=True)
+    def _normalize_serial(img_in: np.ndarray, out: np.ndarray) -> None:
+        for c in range(img_in.shape[0]):
+            for i in range(img_in.shape[1]):
+                for j in range(img_in.shape[2]):
+                    out[c, i, j] = _normalize_value(img_in[c, i, j])
+
+else:
+    _normalize = _normalize_serial = None
+
+# Parallel kernels must not be launched from several threads at once (the
+# workqueue threading layer aborts), nor from threads other than the main
+# one (the TBB layer then hangs at interpreter exit).
+_normalize_lock = threading.Lock()
+
+
+def process_image(
+    image: np.ndarray,
+    dtype: np.typing.DTypeLike = np.float32,
+    parallel: bool = True,
+) -> np.ndarray:
+    """Normalize S1 backscatter to [0, 1], in a single pass.
+
+    Uses a fused Numba kernel when numba is installed, multi-threaded unless
+    `parallel=False` (which is required outside the main thread). Either way
+    the result is a new array and `image` is left unchanged. It is cast to
+    `dtype` at the end, e.g. `bfloat16` to halve its size.
+    """
+    if _normalize is not None and image.ndim == 3:
+        out = np.empty(image.shape, dtype=np.float32)
+        if parallel:
+            with _normalize_lock:
+                _normalize(image, out)
+        else:
+            _normalize_serial(image, out)
+    else:
+        # A single copy, which the steps below then update in place.
+        out = image.astype(np.float32)
+        np.nan_to_num(out, copy=False)
+        np.clip(out, -50.0, 1.0, out=out)
+        out += 50.0
+        out *= 1.0 / 51.0
+    return out.astype(dtype, copy=False)
+
+
+def process_mask(mask: np.ndarray) -> np.ndarray:
+    """Return the mask as uint8, with the no-data label (-1) mapped to 255."""
+    if mask.dtype.kind == "f":
+        mask = mask.astype(np.int16)
+    # The wrapping integer cast maps -1 to 255 and leaves 0 and 1 unchanged.
+    return mask.astype(np.uint8)
+
+
+# Tiles are processed in the loading threads, where kernels must be serial.
+_process_image_serial = functools.partial(process_image, parallel=False)
+
+
+def process_sample(data: dict, image_dtype: np.typing.DTypeLike = np.float32) -> dict:
+    """Default `process_func` applying `process_image` and `process_mask`.
+
+    Use `functools.partial(process_sample, image_dtype=ml_dtypes.bfloat16)`
+    for bfloat16 images.
+    """
+    return {
+        **data,
+        "image": process_image(data["image"], dtype=image_dtype),
+        "mask": process_mask(data["mask"]),
+    }
+
+
+def _map_samples(
+    process_func: Callable[[dict], dict] | None,
+    samples: Generator[dict, None, None],
+) -> Generator[dict, None, None]:
+    # The callback is resolved once, and skipped entirely when absent.
+    if process_func is None:
+        return samples
+    return _yield_mapped(process_func, samples)
+
+
+def _yield_mapped(
+    process_func: Callable[[dict], dict],
+    samples: Generator[dict, None, None],
+) -> Generator[dict, None, None]:
+    try:
+        for data in samples:
+            yield process_func(data)
+    finally:
+        samples.close()
+
+
+def _write_atomic(path: Path, data: bytes) -> None:
+    # A partial file left by an interrupted write would be reused as a cache.
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _save_zst(path: Path, array: np.ndarray) -> None:
+    buffer = BytesIO()
+    np.save(buffer, np.ascontiguousarray(array), allow_pickle=False)
+    _write_atomic(
+        path, zstandard.ZstdCompressor(level=3).compress(buffer.getbuffer())
+    )
+
+
+def _load_zst(path: Path) -> np.ndarray:
+    buffer = zstandard.ZstdDecompressor().decompress(path.read_bytes())
+    return np.load(BytesIO(buffer), allow_pickle=False)
+
+
+def _out_buffer(
+    out: np.ndarray | None,
+    shape: tuple[int, int, int],
+    dtype: np.dtype,
+    channels_last: bool = False,
+) -> np.ndarray:
+    """Return `out` if it fits a `(bands, height, width)` tile, else a new one.
+
+    With `channels_last`, new buffers are transposed views of C-contiguous
+    `(height, width, bands)` arrays.
+    """
+    if out is not None and out.shape == shape and out.dtype == dtype:
+        return out
+    if channels_last:
+        bands, height, width = shape
+        return np.empty((height, width, bands), dtype=dtype).transpose(2, 0, 1)
+    return np.empty(shape, dtype=dtype)
+
+
+_TIFF_TYPES = {3: "H", 4: "I"}
+_TIFF_DTYPES = {1: "u", 2: "i", 3: "f"}
+
+
+def _to_layout(array: np.ndarray, channels_last: bool = False) -> np.ndarray:
+    # Returns a `(bands, height, width)` view of an array that is C-contiguous
+    # in the requested layout, as the buffers from `_out_buffer` are.
+    if not channels_last:
+        return np.ascontiguousarray(array)
+    return np.ascontiguousarray(array.transpose(1, 2, 0)).transpose(2, 0, 1)
+
+
+def _parse_tiff(
+    mm: mmap.mmap,
+) -> tuple[np.dtype, int, tuple[int, int, int], bool] | None:
+    """Return `(dtype, offset, (bands, height, width), planar)` of the pixels.
+
+    Raises `struct.error` on truncated headers.
+    """
+    if mm[:4] not in (b"II*\0", b"MM\0*"):
+        return None
+    endian = "<" if mm[:2] == b"II" else ">"
+    (ifd,) = struct.unpack_from(endian + "I", mm, 4)
+    (n_tags,) = struct.unpack_from(endian + "H", mm, ifd)
+    tags = {}
+    for i in range(n_tags):
+        tag, typ, count, value = struct.unpack_from(
+            endian + "HHI4s", mm, ifd + 2 + 12 * i
+        )
+        if typ not in _TIFF_TYPES:
+            continue
+        fmt = endian + _TIFF_TYPES[typ] * count
+        size = struct.calcsize(fmt)
+        if size <= 4:
+            tags[tag] = struct.unpack_from(fmt, value)
+        else:
+            (offset,) = struct.unpack(endian + "I", value)
+            tags[tag] = struct.unpack_from(fmt, mm, offset)
+
+    if (
+        tags.get(259, (1,))[0] != 1
+        or 322 in tags
+        or not {256, 257, 273, 279} <= tags.keys()
+    ):
+        return None
+    width, height = tags[256][0], tags[257][0]
+    bands = tags.get(277, (1,))[0]
+    bits = set(tags.get(258, (1,)))
+    sample_format = set(tags.get(339, (1,)))
+    if len(bits) != 1 or len(sample_format) != 1:
+        return None
+    kind = _TIFF_DTYPES.get(sample_format.pop())
+    try:
+        dtype = np.dtype(f"{endian}{kind}{bits.pop() // 8}")
+    except TypeError:
+        return None
+
+    offsets, counts = tags[273], tags[279]
+    nbytes = width * height * bands * dtype.itemsize
+    if (
+        sum(counts) != nbytes
+        or offsets[0] + nbytes > len(mm)
+        or any(o + c != n for o, c, n in zip(offsets, counts, offsets[1:]))
+    ):
+        return None
+    planar = tags.get(284, (1,))[0] == 2
+    return dtype, offsets[0], (bands, height, width), planar
+
+
+def _read_tiff(
+    path: Path,
+    out: np.ndarray | None = None,
+    channels_last: bool = False,
+    memmap: bool = False,
+) -> np.ndarray | None:
+    """Read an uncompressed, striped, classic TIFF without GDAL.
+
+    Returns a C-contiguous `(bands, height, width)` array (a view of a
+    `(height, width, bands)` one with `channels_last`). With `memmap`, band
+    sequential native-endian files are instead returned as a copy-on-write
+    memory map when no `out` is given. Returns None when the file uses a
+    layout this reader does not handle (compression, tiles, BigTIFF, ...) or
+    is empty or truncated, in which case the caller should fall back to
+    rasterio.
+    """
+    try:
+        with (
+            path.open("rb") as f,
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm,
+        ):
+            layout = _parse_tiff(mm)
+    except (ValueError, struct.error):
+        return None
+    if layout is None:
+        return None
+    dtype, offset, (bands, height, width), planar = layout
+
+    # Map the pixel data copy-on-write, so in-place processing of a returned
+    # view stays private. Each live map holds a file descriptor.
+    data = np.memmap(
+        path,
+        dtype=dtype,
+        mode="c",
+        offset=offset,
+        shape=(bands * height * width,),
+    )
+    if planar:
+        data = data.reshape(bands, height, width)
+    else:
+        data = data.reshape(height, width, bands).transpose(2, 0, 1)
+    zero_copy = (planar or bands == 1) and dtype.isnative
+    if memmap and zero_copy and out is None and not channels_last:
+        return data
+    out = _out_buffer(out, data.shape, dtype.newbyteorder("="), channels_last)
+    np.copyto(out, data)
+    return out
+
+
+class _TileStore:
+    """Load tiles from a local DVC checkout, streaming missing ones from DVC."""
+
+    GDAL_ENV = {
+        "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+        "GDAL_CACHEMAX": 512,
+        "CPL_VSIL_CURL_ALLOWED_EXTENSIONS": ".tif",
+        "GDAL_NUM_THREADS": "ALL_CPUS",
+    }
+
+    def __init__(
+        self,
+        context: Path,
+        dvc_fs: DVCFileSystem | Callable[[], DVCFileSystem] | None = None,
+    ) -> None:
+        self.context = context
+        self._dvc_fs_factory = dvc_fs
+        self._dvc_fs: DVCFileSystem | None = None
+        self._dvc_fs_lock = threading.Lock()
+
+    @property
+    def dvc_fs(self) -> DVCFileSystem:
+        # Opening the DVC repo is only needed when a tile is missing locally,
+        # which loading threads may find at the same time.
+        with self._dvc_fs_lock:
+            if self._dvc_fs is None:
+                if self._dvc_fs_factory is None:
+                    self._dvc_fs = DVCFileSystem(repo=self.context)
+                elif callable(self._dvc_fs_factory):
+                    self._dvc_fs = self._dvc_fs_factory()
+                else:
+                    self._dvc_fs = self._dvc_fs_factory
+            return self._dvc_fs
+
+    def get_batch(
+        self,
+        entries: list[tuple[Path, str, str]],
+        stream: bool = False,
+        cache: bool = True,
+        outs: Sequence[np.ndarray | None] | None = None,
+        processes: list[Callable[[np.ndarray], np.ndarray] | None] | None = None,
+        channels_last: bool = False,
+        memmap: bool = False,
+    ) -> list[np.ndarray]:
+        """Load `(local_dir, dvc_dir, image_name)` entries.
+
+        Tiles are read into the matching `outs` buffer when its shape and
+        dtype fit the tile, and into a new buffer otherwise (backed by a
+        `(height, width, bands)` array with `channels_last`). Entries with a
+        function in `processes` are returned processed, and cached as such in
+        a `.npy.zst` file next to the tile (always as `(bands, height, width)`).
+        """
+        local_paths = [local_dir / image_name for local_dir, _, image_name in entries]
+        processed_paths = [
+            local_path.with_suffix(".npy.zst") if processes and processes[i] else None
+            for i, local_path in enumerate(local_paths)
+        ]
+        cached = {
+            i: _load_zst(processed_path)
+            for i, processed_path in enumerate(processed_paths)
+            if processed_path is not None and processed_path.is_file()
+        }
+        missing = {
+            i: dvc_dir + image_name
+            for i, ((_, dvc_dir, image_name), local_path) in enumerate(
+                zip(entries, local_paths)
+            )
+            if i not in cached and not local_path.is_file()
+        }
+        if missing and not stream:
+            local_path = local_paths[next(iter(missing))]
+            raise RuntimeError(f"File not accessible: {local_path}")
+        # fsspec's `cat` fetches the paths one after the other: concurrency
+        # comes from loading one row per task on the caller's thread pool.
+        blobs = self.dvc_fs.cat(list(missing.values())) if missing else {}
+
+        images = []
+        # rasterio environments are thread-local, so one is entered per task
+        # in the worker thread rather than per open.
+        with rasterio.Env(**self.GDAL_ENV):
+            for i, local_path in enumerate(local_paths):
+                if i in cached:
+                    images.append(_to_layout(cached[i], channels_last))
+                    continue
+                out = outs[i] if outs else None
+                if i not in missing:
+                    image = self.read_local(local_path, out, channels_last, memmap)
+                elif cache:
+                    # Write the raw bytes first and decode the cached file once.
+                    _write_atomic(local_path, blobs[missing[i]])
+                    image = self.read_local(local_path, out, channels_last, memmap)
+                else:
+                    # MemoryFile hands the bytes to GDAL's /vsimem/ driver.
+                    with (
+                        rasterio.MemoryFile(blobs[missing[i]]) as mf,
+                        mf.open() as src,
+                    ):
+                        image = self._read_src(src, out, channels_last)
+                if processed_paths[i] is not None:
+                    image = processes[i](image)
+                    _save_zst(processed_paths[i], image)
+                    image = _to_layout(image, channels_last)
+                images.append(image)
+        return images
+
+    @classmethod
+    def read_local(
+        cls,
+        local_path: Path,
+        out: np.ndarray | None = None,
+        channels_last: bool = False,
+        memmap: bool = False,
+    ) -> np.ndarray:
+        image = _read_tiff(
+            local_path, out=out, channels_last=channels_last, memmap=memmap
+        )
+        if image is None:
+            with rasterio.open(local_path) as src:
+                image = cls._read_src(src, out, channels_last)
+        return image
+
+    @staticmethod
+    def _read_src(
+        src: rasterio.DatasetReader,
+        out: np.ndarray | None = None,
+        channels_last: bool = False,
+    ) -> np.ndarray:
+        shape = (src.count, src.height, src.width)
+        dtype = np.dtype(src.dtypes[0])
+        return src.read(out=_out_buffer(out, shape, dtype, channels_last))
+
 
 @runtime_checkable
 class DatasetGenerator(Protocol):
@@ -36,6 +466,8 @@ class DatasetLoader(Mapping):
             if context is Ellipsis
             else Path(context).resolve()
         )
+        self._dvc_fs: DVCFileSystem | None = None
+        self._dvc_fs_lock = threading.Lock()
 
     def __len__(self) -> int:
         return len(self.SPLITS)
@@ -45,28 +477,170 @@ class DatasetLoader(Mapping):
 
     def __getitem__(self, key: str) -> DatasetGenerator:
         return FloodDatasetGenerator(
-            context=self.context, split=self.SPLITS.get(key, key)
+            context=self.context,
+            split=self.SPLITS.get(key, key),
+            dvc_fs=self._get_dvc_fs,
+        )
+
+    def _get_dvc_fs(self) -> DVCFileSystem:
+        # Shared by all splits, whose generators may run concurrently.
+        with self._dvc_fs_lock:
+            if self._dvc_fs is None:
+                self._dvc_fs = DVCFileSystem(repo=self.context)
+            return self._dvc_fs
+
+    def materialize(
+        self,
+        key: str,
+        shard_path: str | Path,
+        batch_size: int = 64,
+        **kwargs: Any,
+    ) -> "FloodParquetGenerator":
+        """Write a split to a single ZSTD-compressed Parquet shard.
+
+        Extra keyword arguments are passed to the split generator (e.g.
+        `stream=True`); tiles are always stored channels-first, and `copy` is
+        forced on. Returns a generator reading back from the shard.
+        """
+        if pq is None:
+            raise ImportError("pyarrow is required to materialize a split")
+        generator = self[key]
+        schema = FloodParquetGenerator.schema()
+        # Samples are batched before writing, so they must not share buffers.
+        samples = generator(**{**kwargs, "channels_last": False, "copy": True})
+        with pq.ParquetWriter(shard_path, schema, compression="zstd") as writer:
+            while batch := [*itertools.islice(samples, batch_size)]:
+                images = np.stack([sample["image"] for sample in batch])
+                masks = np.stack([sample["mask"] for sample in batch])
+                columns = {
+                    "image": images.astype(np.float32, copy=False),
+                    "mask": masks.astype(np.int8, copy=False),
+                }
+                writer.write_table(
+                    pa.table(
+                        {
+                            name: pa.FixedSizeListArray.from_arrays(
+                                values.ravel(), values[0].size
+                            )
+                            for name, values in columns.items()
+                        },
+                        schema=schema,
+                    )
+                )
+        return FloodParquetGenerator(shard_path)
+
+
+class FloodParquetGenerator(DatasetGenerator):
+    """Read samples from a shard written by `DatasetLoader.materialize`."""
+
+    def __init__(self, shard_path: str | Path) -> None:
+        if pq is None:
+            raise ImportError("pyarrow is required to read Parquet shards")
+        self.shard_path = Path(shard_path)
+
+    @staticmethod
+    def schema() -> "pa.Schema":
+        image_size = int(np.prod(FloodDatasetGenerator.IMAGE_SHAPE))
+        mask_size = int(np.prod(FloodDatasetGenerator.MASK_SHAPE))
+        return pa.schema(
+            [
+                ("image", pa.list_(pa.float32(), image_size)),
+                ("mask", pa.list_(pa.int8(), mask_size)),
+            ]
+        )
+
+    def __len__(self) -> int:
+        return pq.ParquetFile(self.shard_path).metadata.num_rows
+
+    def __call__(
+        self,
+        shuffle: bool = False,
+        process_func: Callable[[dict], dict] | None = None,
+        batch_size: int = 64,
+        channels_last: bool = False,
+        **kwargs,
+    ) -> Generator[dict, None, None]:
+        return _map_samples(
+            process_func,
+            self._yield_raw(
+                shuffle=shuffle, batch_size=batch_size, channels_last=channels_last
+            ),
         )
 
+    def _yield_raw(
+        self,
+        *,
+        shuffle: bool,
+        batch_size: int,
+        channels_last: bool,
+    ) -> Generator[dict, None, None]:
+        parquet_file = pq.ParquetFile(self.shard_path)
+        row_groups = np.arange(parquet_file.num_row_groups)
+        if shuffle:
+            row_groups = np.random.permutation(row_groups)
+        for row_group in row_groups:
+            for batch in parquet_file.iter_batches(
+                batch_size=batch_size, row_groups=[int(row_group)]
+            ):
+                images = (
+                    batch.column("image")
+                    .flatten()
+                    .to_numpy(zero_copy_only=False, writable=True)
+                    .reshape(-1, *FloodDatasetGenerator.IMAGE_SHAPE)
+                )
+                masks = (
+                    batch.column("mask")
+                    .flatten()
+                    .to_numpy(zero_copy_only=False, writable=True)
+                    .reshape(-1, *FloodDatasetGenerator.MASK_SHAPE)
+                )
+                if channels_last:
+                    # One copy per batch, so that each sample is C-contiguous.
+                    images = np.ascontiguousarray(images.transpose(0, 2, 3, 1))
+                    masks = np.ascontiguousarray(masks.transpose(0, 2, 3, 1))
+                order = (
+                    np.random.permutation(len(images))
+                    if shuffle
+                    else range(len(images))
+                )
+                for index in order:
+                    yield {"image": images[index], "mask": masks[index]}
+
 
 class FloodDatasetGenerator(DatasetGenerator):
     S1 = "v1.1/data/flood_events/HandLabeled/S1Hand/"
     LABELS = "v1.1/data/flood_events/HandLabeled/LabelHand/"
+    IMAGE_SHAPE = (2, 512, 512)
+    MASK_SHAPE = (1, 512, 512)
 
     def __init__(
         self,
         context: Path,
         split: str,
+        dvc_fs: DVCFileSystem | Callable[[], DVCFileSystem] | None = None,
     ) -> None:
         self.context = context
         self.split = split
-        self._dvc_fs = DVCFileSystem(repo=self.context)
+        self._store = _TileStore(self.context, dvc_fs=dvc_fs)
+        self._len: int | None = None
+        # Resolved once so the per-row path is a single join.
+        self._s1_dir = self.context / self.S1
+        self._labels_dir = self.context / self.LABELS
+        self._dvc_s1 = "/" + self.S1
+        self._dvc_labels = "/" + self.LABELS
 
     def __len__(self) -> int:
-        csv_file_path = self.context / self.split
-        with csv_file_path.open() as f:
-            csv_reader = csv.reader(f, delimiter=",")
-            return len(tuple(csv_reader))
+        if self._len is None:
+            csv_file_path = self.context / self.split
+            count = 0
+            last = b"\n"
+            with csv_file_path.open("rb") as f:
+                for buf in iter(lambda: f.read(1 << 20), b""):
+                    count += buf.count(b"\n")
+                    last = buf[-1:]
+            # Account for a last row without a trailing newline.
+            self._len = count + (last != b"\n")
+        return self._len
 
     def __call__(
         self,
@@ -74,49 +648,168 @@ class FloodDatasetGenerator(DatasetGenerator):
         stream: bool = False,
         stream_cache: bool = True,
         process_func: Callable[[dict], dict] | None = None,
+        prefetch: int = 8,
+        num_workers: int = 4,
+        copy: bool = True,
+        shard_ids: Sequence[int] | None = None,
+        num_shards: int | None = None,
+        cache_processed: bool = False,
+        channels_last: bool = False,
+        memmap: bool = False,
         **kwargs,
     ) -> Generator[dict, None, None]:
-        csv_file_path = self.context / self.split
-        with csv_file_path.open() as f:
-            csv_reader = csv.reader(f, delimiter=",")
-            rows = [*csv_reader]
+        """Yield `{"image", "mask"}` samples for the split.
 
-            if shuffle:
-                random.shuffle(rows)
+        With `copy=False`, images are read into scratch buffers that are
+        recycled once the sample has been consumed: yielded arrays are only
+        valid until the next sample is requested. With `stream=True`, missing
+        files are fetched from DVC.
 
-            for row in rows:
-                data = {
-                    "image": self._load_image(
-                        self.S1, row[0], stream=stream, stream_cache=stream_cache
-                    ),
-                    "mask": self._load_image(
-                        self.LABELS, row[1], stream=stream, stream_cache=stream_cache
+        With `channels_last=True`, samples are `(height, width, bands)`
+        instead of `(bands, height, width)`. Tiles are read straight into
+        C-contiguous channels-last buffers, so no transposed copy is needed
+        downstream (e.g. for `datasets` `Array3D((512, 512, 2))` features).
+
+        With `memmap=True`, cached band-sequential tiles are returned as
+        copy-on-write memory maps instead of copies. Each one keeps a file
+        descriptor open while it is alive.
+
+        With `cache_processed=True`, samples are yielded already normalized,
+        as by `process_sample`: tiles are passed through `process_image` (with
+        `parallel=False`) and `process_mask` in the loading threads, and the
+        results are cached next to the tiles as zstd-compressed `.npy.zst`
+        files (requires zstandard), so later epochs skip TIFF decoding. It
+        cannot be combined with `process_func`, which would be applied on top
+        of the normalization.
+
+        `shard_ids` restricts the split to these shards out of `num_shards`
+        contiguous slices of the CSV, so that `datasets` can distribute
+        `gen_kwargs={"shard_ids": [...], "num_shards": n}` over `num_proc`
+        processes.
+        """
+        if process_func is not None and cache_processed:
+            raise ValueError("process_func cannot be combined with cache_processed")
+        return _map_samples(
+            process_func,
+            self._yield_raw(
+                shuffle=shuffle,
+                stream=stream,
+                stream_cache=stream_cache,
+                prefetch=prefetch,
+                num_workers=num_workers,
+                copy=copy,
+                shard_ids=shard_ids,
+                num_shards=num_shards,
+                cache_processed=cache_processed,
+                channels_last=channels_last,
+                memmap=memmap,
+            ),
+        )
+
+    def _yield_raw(
+        self,
+        *,
+        shuffle: bool,
+        stream: bool,
+        stream_cache: bool,
+        prefetch: int,
+        num_workers: int,
+        copy: bool,
+        shard_ids: Sequence[int] | None,
+        num_shards: int | None,
+        cache_processed: bool,
+        channels_last: bool,
+        memmap: bool,
+    ) -> Generator[dict, None, None]:
+        if cache_processed and zstandard is None:
+            raise ImportError("zstandard is required for cache_processed")
+
+        # Images are loaded ahead of consumption so that disk and DVC I/O
+        # overlap with whatever the caller does with the yielded samples.
+        # Each row is a single task, so keep at least one per worker queued.
+        in_flight = max(prefetch, num_workers, 1)
+        with ThreadPoolExecutor(max_workers=max(num_workers, 1)) as executor:
+
+            # With copy=False, buffers are recycled through a ring holding one
+            # pair per in-flight sample plus the one being consumed. Slots
+            # start empty and keep whatever the store allocated for the tile.
+            ring: list[tuple[np.ndarray, np.ndarray] | None] = (
+                [] if copy else [None] * (in_flight + 1)
+            )
+            slots = itertools.cycle(range(len(ring))) if ring else None
+
+            def submit(row: Sequence[str]) -> tuple[Future, int | None]:
+                slot = next(slots) if ring else None
+                future = executor.submit(
+                    self._store.get_batch,
+                    [
+                        (self._s1_dir, self._dvc_s1, row[0]),
+                        (self._labels_dir, self._dvc_labels, row[1]),
+                    ],
+                    stream=stream,
+                    cache=stream_cache,
+                    outs=ring[slot] if ring else None,
+                    processes=(
+                        [_process_image_serial, process_mask]
+                        if cache_processed
+                        else None
                     ),
-                }
-                if process_func:
-                    data = process_func(data)
-                yield data
+                    channels_last=channels_last,
+                    memmap=memmap and copy,
+                )
+                return future, slot
 
-    def _load_image(
+            rows_iter = self._rows(
+                shuffle=shuffle, shard_ids=shard_ids, num_shards=num_shards
+            )
+            pending: deque[tuple[Future, int | None]] = deque(
+                submit(row) for row in itertools.islice(rows_iter, in_flight)
+            )
+            try:
+                while pending:
+                    future, slot = pending.popleft()
+                    image, mask = future.result()
+                    if ring:
+                        ring[slot] = (image, mask)
+                    # The slot of the previous sample is free again, as the
+                    # caller asked for this one.
+                    next_row = next(rows_iter, None)
+                    if next_row is not None:
+                        pending.append(submit(next_row))
+                    if channels_last:
+                        # Undo the read-side view to get the HWC buffers.
+                        image = image.transpose(1, 2, 0)
+                        mask = mask.transpose(1, 2, 0)
+                    yield {"image": image, "mask": mask}
+            finally:
+                rows_iter.close()
+                for future, _ in pending:
+                    future.cancel()
+
+    def _rows(
         self,
-        image_dir: str,
-        image_name: str,
-        stream: bool = False,
-        stream_cache: bool = True,
-    ) -> np.ndarray:
-        local_path = self.context / image_dir / image_name
-        if local_path.is_file():
-            with rasterio.open(local_path) as src:
-                image = src.read()
-        elif stream:
-            dvc_path = Path("/", image_dir, image_name)
-            binary_image = self._dvc_fs.read_bytes(dvc_path)
-            image_stream = BytesIO(binary_image)
-            with rasterio.open(image_stream) as src:
-                image = src.read()
-                if stream_cache:
-                    local_path.parent.mkdir(parents=True, exist_ok=True)
-                    local_path.write_bytes(data=image_stream.getbuffer())
-        else:
-            raise RuntimeError(f"File not accessible: {local_path}")
-        return image
+        shuffle: bool = False,
+        shard_ids: Sequence[int] | None = None,
+        num_shards: int | None = None,
+    ) -> Generator[Sequence[str], None, None]:
+        csv_file_path = self.context / self.split
+        with csv_file_path.open() as f:
+            csv_reader = csv.reader(f, delimiter=",")
+            if shard_ids is not None:
+                # Shard k covers the k-th contiguous slice of the CSV rows.
+                if num_shards is None:
+                    raise ValueError("num_shards is required with shard_ids")
+                n_rows = len(self)
+                selected = np.zeros(n_rows, dtype=bool)
+                for shard_id in shard_ids:
+                    start = shard_id * n_rows // num_shards
+                    stop = (shard_id + 1) * n_rows // num_shards
+                    selected[start:stop] = True
+                csv_reader = itertools.compress(csv_reader, selected)
+            if not shuffle:
+                yield from csv_reader
+                return
+            # A single (N, 2) object array is lighter than N row lists.
+            rows = np.array([*csv_reader], dtype=object)
+        for index in np.random.permutation(len(rows)):
+            yield rows[index]
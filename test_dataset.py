@@ -0,0 +1,272 @@
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+pytest.importorskip("rasterio")
+pytest.importorskip("dvc.api")
+tifffile = pytest.importorskip("tifffile")
+
+import dataset  # noqa: E402
+from dataset import (  # noqa: E402
+    DatasetLoader,
+    FloodDatasetGenerator,
+    _read_tiff,
+    process_image,
+    process_mask,
+)
+
+IMAGE = np.random.default_rng(0).random((2, 64, 48), dtype=np.float32)
+
+
+@pytest.fixture
+def tiles(tmp_path):
+    """Write a 5-row `split.csv` of small S1 and label tiles to `tmp_path`."""
+    rng = np.random.default_rng(1)
+    images = rng.normal(-20.0, 15.0, (5, 2, 16, 12)).astype(np.float32)
+    masks = rng.integers(-1, 2, (5, 1, 16, 12)).astype(np.int16)
+    s1_dir = tmp_path / FloodDatasetGenerator.S1
+    labels_dir = tmp_path / FloodDatasetGenerator.LABELS
+    s1_dir.mkdir(parents=True)
+    labels_dir.mkdir(parents=True)
+    rows = []
+    for i, (image, mask) in enumerate(zip(images, masks)):
+        rows.append(f"s1_{i}.tif,label_{i}.tif\n")
+        tifffile.imwrite(s1_dir / f"s1_{i}.tif", image, planarconfig="separate")
+        tifffile.imwrite(labels_dir / f"label_{i}.tif", mask, photometric="minisblack")
+    (tmp_path / "split.csv").write_text("".join(rows))
+    return tmp_path, images, masks
+
+
+@pytest.mark.parametrize("byteorder", ["<", ">"])
+@pytest.mark.parametrize("planarconfig", ["contig", "separate"])
+@pytest.mark.parametrize("rowsperstrip", [None, 5])
+def test_read_tiff_round_trip(tmp_path, byteorder, planarconfig, rowsperstrip):
+    path = tmp_path / "tile.tif"
+    data = IMAGE if planarconfig == "separate" else IMAGE.transpose(1, 2, 0)
+    tifffile.imwrite(
+        path,
+        data.astype(byteorder + "f4"),
+        byteorder=byteorder,
+        planarconfig=planarconfig,
+        rowsperstrip=rowsperstrip,
+    )
+    image = _read_tiff(path)
+    assert image.shape == IMAGE.shape
+    assert image.dtype.isnative
+    np.testing.assert_array_equal(image, IMAGE)
+
+
+def test_read_tiff_into_buffer(tmp_path):
+    path = tmp_path / "mask.tif"
+    mask = np.array([[[-1, 0], [1, 0]]], dtype=np.int16)
+    tifffile.imwrite(path, mask, photometric="minisblack")
+    out = np.empty(mask.shape, dtype=np.int16)
+    assert _read_tiff(path, out=out) is out
+    np.testing.assert_array_equal(out, mask)
+
+
+def test_read_tiff_channels_last(tmp_path):
+    path = tmp_path / "tile.tif"
+    tifffile.imwrite(path, IMAGE, planarconfig="separate")
+    image = _read_tiff(path, channels_last=True)
+    assert image.transpose(1, 2, 0).flags["C_CONTIGUOUS"]
+    np.testing.assert_array_equal(image, IMAGE)
+
+
+@pytest.mark.parametrize(
+    "kwargs", [{"compression": "zlib"}, {"tile": (32, 32)}], ids=["zlib", "tiled"]
+)
+def test_read_tiff_unsupported_layout(tmp_path, kwargs):
+    path = tmp_path / "tile.tif"
+    tifffile.imwrite(path, IMAGE, planarconfig="separate", **kwargs)
+    assert _read_tiff(path) is None
+
+
+@pytest.mark.parametrize("size", [0, 6, 200, -100])
+def test_read_tiff_truncated(tmp_path, size):
+    path = tmp_path / "tile.tif"
+    tifffile.imwrite(path, IMAGE, planarconfig="separate")
+    content = path.read_bytes()
+    path.write_bytes(content[:size])
+    assert _read_tiff(path) is None
+
+
+@pytest.mark.parametrize("planarconfig", ["contig", "separate"])
+def test_read_tiff_copies_by_default(tmp_path, planarconfig):
+    path = tmp_path / "tile.tif"
+    data = IMAGE if planarconfig == "separate" else IMAGE.transpose(1, 2, 0)
+    tifffile.imwrite(path, data, planarconfig=planarconfig)
+    image = _read_tiff(path)
+    assert not isinstance(image, np.memmap)
+    assert image.flags["C_CONTIGUOUS"]
+
+
+def test_read_tiff_memmap(tmp_path):
+    path = tmp_path / "tile.tif"
+    tifffile.imwrite(path, IMAGE, planarconfig="separate")
+    image = _read_tiff(path, memmap=True)
+    assert isinstance(image, np.memmap)
+    image += 1
+    np.testing.assert_array_equal(_read_tiff(path), IMAGE)
+
+
+def test_read_tiff_memmap_pixel_interleaved(tmp_path):
+    path = tmp_path / "tile.tif"
+    tifffile.imwrite(path, IMAGE.transpose(1, 2, 0), planarconfig="contig")
+    image = _read_tiff(path, memmap=True)
+    assert not isinstance(image, np.memmap)
+    assert image.flags["C_CONTIGUOUS"]
+
+
+@pytest.mark.parametrize("kernel", ["numba", "numba-serial", "numpy"])
+def test_process_image_leaves_input(monkeypatch, kernel):
+    if kernel == "numpy":
+        monkeypatch.setattr(dataset, "_normalize", None)
+    elif dataset._normalize is None:
+        pytest.skip("numba is not installed")
+    image = np.array([[[np.nan, -60.0, 1.0, 2.0]]] * 2, dtype=np.float32)
+    original = image.copy()
+    processed = process_image(image, parallel=kernel != "numba-serial")
+    np.testing.assert_array_equal(image, original)
+    expected = [[[50 / 51, 0.0, 1.0, 1.0]]] * 2
+    np.testing.assert_allclose(processed, expected, atol=1e-6)
+
+
+def test_stream_opens_dvc_only_for_missing_tiles(tiles):
+    context, images, _ = tiles
+    opened = []
+    generator = FloodDatasetGenerator(
+        context, "split.csv", dvc_fs=lambda: opened.append(True)
+    )
+    assert len(list(generator(stream=True))) == len(images)
+    assert not opened
+
+
+def test_call_shuffle_positionally(tiles):
+    context, images, _ = tiles
+    generator = FloodDatasetGenerator(context, "split.csv")
+    samples = list(generator(True))
+    assert sorted(sample["image"].tobytes() for sample in samples) == sorted(
+        image.tobytes() for image in images
+    )
+
+
+def test_cache_processed_exits(tiles):
+    # Parallel kernels launched from the loading threads used to hang the
+    # interpreter at exit under numba's TBB threading layer.
+    pytest.importorskip("zstandard")
+    context, images, _ = tiles
+    script = (
+        "import sys; from pathlib import Path; import dataset; "
+        "g = dataset.FloodDatasetGenerator(Path(sys.argv[1]), 'split.csv'); "
+        "print(len(list(g(cache_processed=True))))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", script, str(context)],
+        cwd=Path(__file__).parent,
+        capture_output=True,
+        text=True,
+        timeout=300,
+    )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.split() == [str(len(images))]
+
+
+@pytest.mark.parametrize("dtype", [np.int16, np.float32])
+def test_process_mask_wraps_no_data(dtype):
+    mask = np.array([[[-1, 0, 1]]], dtype=dtype)
+    processed = process_mask(mask)
+    assert processed.dtype == np.uint8
+    np.testing.assert_array_equal(processed, [[[255, 0, 1]]])
+
+
+def test_copy_false_recycles_buffers(tiles):
+    context, images, masks = tiles
+    generator = FloodDatasetGenerator(context, "split.csv")
+    # One sample in flight plus the one being consumed: two buffer pairs.
+    buffers = set()
+    for sample, image, mask in zip(
+        generator(copy=False, prefetch=1, num_workers=1), images, masks
+    ):
+        # Give the worker time to load the next row: it must not write into
+        # the buffers of the sample being consumed.
+        time.sleep(0.05)
+        np.testing.assert_array_equal(sample["image"], image)
+        np.testing.assert_array_equal(sample["mask"], mask)
+        buffers.add(id(sample["image"]))
+    assert len(buffers) == 2
+
+
+@pytest.mark.parametrize("copy", [True, False])
+def test_channels_last(tiles, copy):
+    context, images, masks = tiles
+    generator = FloodDatasetGenerator(context, "split.csv")
+    for sample, image, mask in zip(
+        generator(copy=copy, channels_last=True), images, masks
+    ):
+        assert sample["image"].flags["C_CONTIGUOUS"]
+        assert sample["mask"].flags["C_CONTIGUOUS"]
+        np.testing.assert_array_equal(sample["image"], image.transpose(1, 2, 0))
+        np.testing.assert_array_equal(sample["mask"], mask.transpose(1, 2, 0))
+
+
+def test_shards_partition_split(tiles):
+    context, _, _ = tiles
+    generator = FloodDatasetGenerator(context, "split.csv")
+    rows = [*generator._rows()]
+    shards = [[*generator._rows(shard_ids=[k], num_shards=3)] for k in range(3)]
+    assert [len(shard) for shard in shards] == [1, 2, 2]
+    assert sum(shards, []) == rows
+    assert [*generator._rows(shard_ids=[0, 2], num_shards=3)] == shards[0] + shards[2]
+    with pytest.raises(ValueError):
+        [*generator._rows(shard_ids=[0])]
+
+
+@pytest.mark.parametrize("channels_last", [False, True])
+def test_cache_processed(tiles, channels_last):
+    pytest.importorskip("zstandard")
+    context, images, masks = tiles
+    generator = FloodDatasetGenerator(context, "split.csv")
+    samples = [*generator(cache_processed=True, channels_last=channels_last)]
+    assert len([*context.rglob("*.npy.zst")]) == 2 * len(images)
+
+    # Cache hits no longer read the tiles, and misses process them again.
+    s1_dir = context / FloodDatasetGenerator.S1
+    for path in s1_dir.glob("*.tif"):
+        tifffile.imwrite(path, np.zeros_like(images[0]), planarconfig="separate")
+    (s1_dir / "s1_0.npy.zst").unlink()
+    cached = [*generator(cache_processed=True, channels_last=channels_last)]
+
+    layout = (lambda a: a.transpose(1, 2, 0)) if channels_last else (lambda a: a)
+    for k, (sample, image, mask) in enumerate(zip(cached, images, masks)):
+        if k == 0:
+            expected = process_image(np.zeros_like(image))
+        else:
+            np.testing.assert_array_equal(sample["image"], samples[k]["image"])
+            expected = process_image(image)
+        np.testing.assert_allclose(sample["image"], layout(expected), atol=1e-6)
+        np.testing.assert_array_equal(sample["mask"], layout(process_mask(mask)))
+        assert sample["image"].flags["C_CONTIGUOUS"]
+        assert sample["mask"].flags["C_CONTIGUOUS"]
+
+
+def test_materialize_round_trip(tiles, monkeypatch, tmp_path):
+    pytest.importorskip("pyarrow")
+    context, images, masks = tiles
+    monkeypatch.setattr(FloodDatasetGenerator, "IMAGE_SHAPE", images.shape[1:])
+    monkeypatch.setattr(FloodDatasetGenerator, "MASK_SHAPE", masks.shape[1:])
+    shard = DatasetLoader(str(context)).materialize(
+        "split.csv", tmp_path / "split.parquet", batch_size=2, copy=False
+    )
+    assert len(shard) == len(images)
+    samples = [*shard(batch_size=3)]
+    np.testing.assert_array_equal([s["image"] for s in samples], images)
+    np.testing.assert_array_equal([s["mask"] for s in samples], masks)
+    for sample, image, mask in zip(shard(channels_last=True), images, masks):
+        assert sample["image"].flags["C_CONTIGUOUS"]
+        np.testing.assert_array_equal(sample["image"], image.transpose(1, 2, 0))
+        np.testing.assert_array_equal(sample["mask"], mask.transpose(1, 2, 0))